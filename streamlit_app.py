@@ -1,12 +1,23 @@
 import streamlit as st
-import base64
+import hashlib
 import io
+import itertools
+import mimetypes
 import os
-from PIL import Image
-from groq import Groq
-from datetime import datetime
+import queue
+import threading
+import time
+import httpx
+from PIL import Image, ImageOps
+from groq import DefaultHttpxClient, Groq
 from dotenv import load_dotenv
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+try:  # optional SIMD base64 (pip install pybase64); same output as the stdlib
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 # ==========================================================
 # CONFIG / SECRETS
 # ==========================================================
@@ -23,7 +34,54 @@ GROQ_API_KEY = get_groq_api_key()
 if not GROQ_API_KEY:
     st.error("❌ GROQ_API_KEY not found. Add it to Streamlit Secrets or create a local .env file.")
     st.stop()
-client = Groq(api_key=GROQ_API_KEY)
+@st.cache_resource(show_spinner=False)
+def get_groq_client(api_key: str) -> Groq:
+    """One client per process so its HTTP connection pool survives reruns."""
+    # The SDK's own httpx defaults (timeout, redirects, 100/20 pool limits), with idle
+    # connections kept for 60 s instead of 5 s so a warm TLS connection usually
+    # survives between one turn and the next.
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+    )
+    return Groq(api_key=api_key, http_client=http_client)
+client = get_groq_client(GROQ_API_KEY)
+# Streaming redraw cadence: flush to the UI at most every 50 ms (~20 redraws/s),
+# however fast tokens arrive.
+STREAM_FLUSH_INTERVAL = 0.05
+# After the interval a flush waits (up to STREAM_FLUSH_MAX_WAIT) for a natural break,
+# so redraws don't end mid-word, unless STREAM_FLUSH_CHARS are already pending.
+STREAM_FLUSH_MAX_WAIT = 0.1
+STREAM_FLUSH_CHARS = 32
+STREAM_FLUSH_BOUNDARY = frozenset(" \n.,:;!?)")
+# Once the live tail of a reply grows past this, finished paragraphs are frozen into
+# their own element so each redraw only re-parses the tail.
+STREAM_TAIL_CHARS = 800
+# Longest side (px) of images sent to the vision model; larger uploads are downscaled.
+MAX_IMAGE_SIDE = 1024
+MODEL = "meta-llama/llama-4-maverick-17b-128e-instruct"
+# Second vision-capable model streamed alongside MODEL when compare mode is on.
+COMPARE_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+# Appended to a reply whose stream failed partway, so history shows it is incomplete.
+REPLY_CUT_OFF = "\n\n*[Reply cut off: the request failed.]*"
+# Stands in for the main reply when only the compare model produced text.
+NO_REPLY = "*[No reply.]*"
+# Reply length cap choices (max_completion_tokens); shorter caps finish sooner.
+MAX_TOKENS_OPTIONS = (256, 512, 1024)
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a professional, helpful AI assistant."}
+# Context window sent to the model: history grows append-only up to CONTEXT_MAX
+# messages, then restarts from the last CONTEXT_RESET. Between resets the request
+# prefix stays byte-identical, which keeps provider-side prompt caching effective.
+# The chat's first user/assistant pair is always kept ahead of the window.
+CONTEXT_MAX = 20
+CONTEXT_RESET = 10
+# Text budget for the same window; long turns restart it early, oldest turns first.
+CONTEXT_MAX_CHARS = 12000
+# Least recently used chats beyond this are dropped (with their images) to bound session memory.
+MAX_CHATS = 20
+# Per-chat history cap; the oldest turns beyond it (after the first) are dropped.
+MAX_CHAT_MESSAGES = 200
+# Only the newest messages of a chat are rendered; "Load earlier" adds a page at a time.
+HISTORY_PAGE = 40
 # ==========================================================
 # PAGE CONFIG
 # ==========================================================
@@ -36,47 +94,65 @@ st.set_page_config(
 # ==========================================================
 # THEME + UI STATE
 # ==========================================================
-if "theme_mode" not in st.session_state:
-    st.session_state.theme_mode = "System"  # Light / Dark / System
-if "starry_bg" not in st.session_state:
-    st.session_state.starry_bg = True
-if "wrap_code" not in st.session_state:
-    st.session_state.wrap_code = False
-if "show_previews" not in st.session_state:
-    st.session_state.show_previews = True
+# Settings defaults (also the keys of the settings widgets). Conversation state is
+# initialised further down, in order: current_chat_id comes from next_chat_id(),
+# which needs chat_seq and conversations to exist first.
+DEFAULTS = {
+    "theme_mode": "System",  # Light / Dark / System
+    "starry_bg": True,
+    "wrap_code": False,
+    "show_previews": True,
+    "compare_mode": False,
+    "max_tokens": 512,  # one of MAX_TOKENS_OPTIONS
+}
+for key, value in DEFAULTS.items():
+    st.session_state.setdefault(key, value)
+# ==========================================================
+# THEME PALETTES
+# ==========================================================
+LIGHT_THEME = {
+    "bg": "#F6F7FB",
+    "bg2": "radial-gradient(900px 520px at 20% 0%, rgba(99,102,241,0.14), transparent 55%),"
+           "radial-gradient(800px 460px at 95% 10%, rgba(236,72,153,0.12), transparent 55%)",
+    "card": "rgba(255,255,255,0.86)",
+    "border": "rgba(15,23,42,0.10)",
+    "text": "#0B1220",
+    "muted": "rgba(11,18,32,0.62)",
+    "user_bg": "rgba(99,102,241,0.16)",
+    "assistant_bg": "rgba(2,6,23,0.04)",
+    "input_bg": "rgba(255,255,255,0.92)",
+    "code_bg": "rgba(2,6,23,0.06)",
+}
+DARK_THEME = {
+    "bg": "#070A12",
+    "bg2": "radial-gradient(1200px 700px at 20% 5%, rgba(120,130,255,0.20), transparent 60%),"
+           "radial-gradient(900px 520px at 90% 15%, rgba(255,90,160,0.14), transparent 55%)",
+    "card": "rgba(17,24,39,0.74)",
+    "border": "rgba(255,255,255,0.12)",
+    "text": "#EAF0FF",
+    "muted": "rgba(234,240,255,0.70)",
+    "user_bg": "rgba(99,102,241,0.24)",
+    "assistant_bg": "rgba(255,255,255,0.06)",
+    "input_bg": "rgba(17,24,39,0.88)",
+    "code_bg": "rgba(255,255,255,0.08)",
+}
+PALETTES = {"Light": LIGHT_THEME, "Dark": DARK_THEME}
+# palette key -> CSS custom property suffix (--ms-<suffix>)
+THEME_VAR_NAMES = {k: k.replace("_", "-") for k in LIGHT_THEME}
+# Starry background; Streamlit serves ./static/<file> at app/static/<file>.
+BG_IMAGE = Path(__file__).parent / "static" / "space_bg.png"
+BG_IMAGE_URL = "app/static/space_bg.png"
+FONT_STACK = "ui-sans-serif, system-ui, -apple-system, Segoe UI, Roboto, Arial"
+CODE_WRAP_CSS = "pre code { white-space: pre-wrap !important; word-break: break-word !important; }"
 # ==========================================================
 # HELPERS
 # ==========================================================
-@st.cache_data(show_spinner=False)
-def _read_file_b64(path_str: str) -> str | None:
-    try:
-        data = Path(path_str).read_bytes()
-        return base64.b64encode(data).decode("utf-8")
-    except Exception:
-        return None
-
-def load_file_b64(path: Path) -> str | None:
-    """Read a local file and return base64 (cached)."""
-    return _read_file_b64(str(path))
-
-def build_global_css(allow_starry: bool, bg_img_b64: str | None) -> str:
-    # Background CSS (kept as plain strings to avoid escaping issues)
-    if allow_starry and bg_img_b64:
-        bg_css = f"""
-        background-color: var(--ms-bg);
-        background-image: var(--ms-bg2), url("data:image/png;base64,{bg_img_b64}");
-        background-size: auto, cover;
-        background-position: center, center;
-        background-attachment: fixed;
-        """
-    else:
-        bg_css = """
-        background-color: var(--ms-bg);
-        background-image: var(--ms-bg2);
-        background-attachment: fixed;
-        """
+def theme_vars(P: Mapping[str, str]) -> str:
+    """Render a palette as the --ms-* custom properties the global CSS reads."""
+    return "".join(f"--ms-{THEME_VAR_NAMES[k]}: {v};" for k, v in P.items())
 
-    return f"""
+# Theme-independent rules; only the background block is filled in (braces doubled for str.format).
+GLOBAL_CSS_TEMPLATE = """
     /* Page background + base typography */
     .stApp {{
       {bg_css}
@@ -213,149 +289,520 @@ def build_global_css(allow_starry: bool, bg_img_b64: str | None) -> str:
     }}
     """
 
-def apply_ui(theme_mode: str, starry_bg: bool, wrap_code: bool) -> None:
+def background_url() -> str | None:
+    """
+    Static URL of the starry background (the browser fetches and caches it), or
+    None if the image is missing or static serving is off in .streamlit/config.toml.
+    """
+    if BG_IMAGE.is_file() and st.get_option("server.enableStaticServing"):
+        return BG_IMAGE_URL
+    return None
+
+def build_global_css(allow_starry: bool, bg_url: str | None) -> str:
+    # Background CSS (kept as plain strings to avoid escaping issues)
+    if allow_starry and bg_url:
+        bg_css = f"""
+        background-color: var(--ms-bg);
+        background-image: var(--ms-bg2), url("{bg_url}");
+        background-size: auto, cover;
+        background-position: center, center;
+        background-attachment: fixed;
+        """
+    else:
+        bg_css = """
+        background-color: var(--ms-bg);
+        background-image: var(--ms-bg2);
+        background-attachment: fixed;
+        """
+
+    return GLOBAL_CSS_TEMPLATE.format_map({"bg_css": bg_css})
+
+@st.cache_resource(show_spinner=False)
+def build_ui_css(theme_mode: str, starry_bg: bool, wrap_code: bool) -> str:
     """
     Light/Dark/System runtime theme via CSS variables.
     Fixes dark-mode readability (global text color + correct chat selectors).
+    Cached per settings combination. cache_resource hands back the same str object
+    (strings are immutable), so a rerun is a plain lookup; cache_data would pickle
+    the ~4 KB result on a miss and unpickle a copy on every hit.
     """
-    LIGHT = {
-        "bg": "#F6F7FB",
-        "bg2": "radial-gradient(900px 520px at 20% 0%, rgba(99,102,241,0.14), transparent 55%),"
-               "radial-gradient(800px 460px at 95% 10%, rgba(236,72,153,0.12), transparent 55%)",
-        "card": "rgba(255,255,255,0.86)",
-        "border": "rgba(15,23,42,0.10)",
-        "text": "#0B1220",
-        "muted": "rgba(11,18,32,0.62)",
-        "user_bg": "rgba(99,102,241,0.16)",
-        "assistant_bg": "rgba(2,6,23,0.04)",
-        "input_bg": "rgba(255,255,255,0.92)",
-        "code_bg": "rgba(2,6,23,0.06)",
-    }
-    DARK = {
-        "bg": "#070A12",
-        "bg2": "radial-gradient(1200px 700px at 20% 5%, rgba(120,130,255,0.20), transparent 60%),"
-               "radial-gradient(900px 520px at 90% 15%, rgba(255,90,160,0.14), transparent 55%)",
-        "card": "rgba(17,24,39,0.74)",
-        "border": "rgba(255,255,255,0.12)",
-        "text": "#EAF0FF",
-        "muted": "rgba(234,240,255,0.70)",
-        "user_bg": "rgba(99,102,241,0.24)",
-        "assistant_bg": "rgba(255,255,255,0.06)",
-        "input_bg": "rgba(17,24,39,0.88)",
-        "code_bg": "rgba(255,255,255,0.08)",
-    }
-
-    code_wrap_css = ""
-    if wrap_code:
-        code_wrap_css = "pre code { white-space: pre-wrap !important; word-break: break-word !important; }"
+    code_wrap_css = CODE_WRAP_CSS if wrap_code else ""
 
     # In System mode we follow the OS theme using prefers-color-scheme
     if theme_mode == "System":
-        css = f"""
+        return f"""
         <style>
-          :root {{
-            --ms-font: ui-sans-serif, system-ui, -apple-system, Segoe UI, Roboto, Arial;
-          }}
+          :root {{ --ms-font: {FONT_STACK}; }}
 
           /* Light defaults */
-          .stApp {{
-            --ms-bg: {LIGHT["bg"]};
-            --ms-bg2: {LIGHT["bg2"]};
-            --ms-card: {LIGHT["card"]};
-            --ms-border: {LIGHT["border"]};
-            --ms-text: {LIGHT["text"]};
-            --ms-muted: {LIGHT["muted"]};
-            --ms-user-bg: {LIGHT["user_bg"]};
-            --ms-assistant-bg: {LIGHT["assistant_bg"]};
-            --ms-input-bg: {LIGHT["input_bg"]};
-            --ms-code-bg: {LIGHT["code_bg"]};
-          }}
+          .stApp {{ {theme_vars(LIGHT_THEME)} }}
 
           @media (prefers-color-scheme: dark) {{
-            .stApp {{
-              --ms-bg: {DARK["bg"]};
-              --ms-bg2: {DARK["bg2"]};
-              --ms-card: {DARK["card"]};
-              --ms-border: {DARK["border"]};
-              --ms-text: {DARK["text"]};
-              --ms-muted: {DARK["muted"]};
-              --ms-user-bg: {DARK["user_bg"]};
-              --ms-assistant-bg: {DARK["assistant_bg"]};
-              --ms-input-bg: {DARK["input_bg"]};
-              --ms-code-bg: {DARK["code_bg"]};
-            }}
+            .stApp {{ {theme_vars(DARK_THEME)} }}
           }}
 
           {code_wrap_css}
-          {build_global_css(allow_starry=False, bg_img_b64=None)}
+          {build_global_css(allow_starry=False, bg_url=None)}
         </style>
         """
-        st.markdown(css, unsafe_allow_html=True)
-        return
 
     # Light/Dark explicit
-    P = DARK if theme_mode == "Dark" else LIGHT
+    P = PALETTES[theme_mode]
 
     # Starry background only in Dark mode (and only if file exists)
-    bg_img_b64 = None
+    bg_url = None
     allow_starry = False
     if theme_mode == "Dark" and starry_bg:
-        # prefer assets/space_bg.png, fallback to ./space_bg.png (older repo layout)
-        p1 = Path(__file__).parent / "assets" / "space_bg.png"
-        p2 = Path(__file__).parent / "space_bg.png"
-        bg_img_b64 = load_file_b64(p1) or load_file_b64(p2)
-        allow_starry = bg_img_b64 is not None
+        bg_url = background_url()
+        allow_starry = bg_url is not None
 
-    css = f"""
+    return f"""
     <style>
-      :root {{
-        --ms-font: ui-sans-serif, system-ui, -apple-system, Segoe UI, Roboto, Arial;
-      }}
+      :root {{ --ms-font: {FONT_STACK}; }}
 
-      .stApp {{
-        --ms-bg: {P["bg"]};
-        --ms-bg2: {P["bg2"]};
-        --ms-card: {P["card"]};
-        --ms-border: {P["border"]};
-        --ms-text: {P["text"]};
-        --ms-muted: {P["muted"]};
-        --ms-user-bg: {P["user_bg"]};
-        --ms-assistant-bg: {P["assistant_bg"]};
-        --ms-input-bg: {P["input_bg"]};
-        --ms-code-bg: {P["code_bg"]};
-      }}
+      .stApp {{ {theme_vars(P)} }}
 
       {code_wrap_css}
-      {build_global_css(allow_starry=allow_starry, bg_img_b64=bg_img_b64)}
+      {build_global_css(allow_starry=allow_starry, bg_url=bg_url)}
     </style>
     """
-    st.markdown(css, unsafe_allow_html=True)
-def image_to_base64(uploaded_file) -> str:
-    image = Image.open(uploaded_file).convert("RGB")
+
+def apply_ui(theme_mode: str, starry_bg: bool, wrap_code: bool) -> None:
+    # Streamlit drops any element a rerun doesn't re-emit, so the style block has to be
+    # written every run; only building it is skipped (cached above).
+    st.markdown(build_ui_css(theme_mode, starry_bg, wrap_code), unsafe_allow_html=True)
+@st.cache_data(show_spinner=False, max_entries=32)
+def _encode_image(raw: bytes, mime: str | None) -> tuple[str, bytes]:
+    """
+    Return (mime, bytes) ready to send for raw upload bytes.
+    Small PNG/JPEG files are sent as-is; anything larger than MAX_IMAGE_SIDE
+    (or in another format) is downscaled and re-encoded.
+    """
+    image = Image.open(io.BytesIO(raw))  # lazy: only the header is parsed here
+    if mime in ("image/png", "image/jpeg") and max(image.size) <= MAX_IMAGE_SIDE:
+        return mime, raw
+    # JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale, which skips most of the
+    # decode work for camera photos; no-op for other formats.
+    image.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    image = ImageOps.exif_transpose(image)  # keep phone photos upright after dropping EXIF
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
     buf = io.BytesIO()
-    image.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode()
+    if "A" in image.getbands() or "transparency" in image.info:
+        image.save(buf, format="PNG", compress_level=1)  # ~3x faster than 6, a bit larger
+        mime = "image/png"
+    else:
+        image.convert("RGB").save(buf, format="JPEG", quality=85)
+        mime = "image/jpeg"
+    return mime, buf.getvalue()
+
+def encode_upload(uploaded_file, raw: bytes | None = None) -> tuple[str, bytes]:
+    """(mime, bytes) for an upload, via the cached _encode_image."""
+    if raw is None:
+        raw = uploaded_file.getvalue()
+    # Browsers occasionally omit the type; fall back to the extension so PNG/JPEG
+    # files still take the pass-through path instead of being re-encoded.
+    mime = uploaded_file.type or mimetypes.guess_type(uploaded_file.name)[0]
+    return _encode_image(raw, mime)
+def store_image(uploaded_file) -> str:
+    """
+    Encode an upload once and keep (mime, bytes) in st.session_state.images.
+    Returns the content-hash id that messages reference instead of the payload.
+    """
+    raw = uploaded_file.getvalue()
+    img_id = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    if img_id not in st.session_state.images:
+        st.session_state.images[img_id] = encode_upload(uploaded_file, raw)
+    return img_id
+def image_data_url(img_id: str) -> str:
+    """
+    Base64 data URL for the API. Only one image goes out per request and it is
+    re-sent every turn until a newer one arrives, so the last URL is memoised.
+    """
+    cached_id, url = st.session_state.image_url
+    if cached_id != img_id:
+        mime, data = st.session_state.images[img_id]
+        url = f"data:{mime};base64,{b64encode(data).decode()}"
+        st.session_state.image_url = (img_id, url)
+    return url
+def message_chars(msg: dict) -> int:
+    """Length of a message's text items (images aren't counted)."""
+    return sum(len(item["text"]) for item in msg["content"] if item["type"] == "text")
+def first_turn_len(chat_messages: list[dict]) -> int:
+    """2 if the chat opens with a complete user/assistant pair (kept by trim_chat), else 0."""
+    if len(chat_messages) >= 2 and chat_messages[1]["role"] == "assistant":
+        return 2
+    return 0
+def context_window(chat_id: str, chat_messages: list[dict]) -> tuple[list[dict], list[dict]]:
+    """
+    (first turn, window) to send for this turn (see CONTEXT_MAX / CONTEXT_RESET /
+    CONTEXT_MAX_CHARS). Once the window moves past the opening user/assistant pair,
+    that pair is kept ahead of it (it never changes, so the cacheable prefix doesn't
+    either), unless it alone would take over half the text budget.
+    """
+    first_turn = chat_messages[:first_turn_len(chat_messages)]
+    first_chars = sum(message_chars(m) for m in first_turn)
+    if first_chars > CONTEXT_MAX_CHARS // 2:
+        first_turn, first_chars = [], 0
+    budget = CONTEXT_MAX_CHARS - first_chars
+    starts = st.session_state.context_starts
+    start = starts.get(chat_id, 0)
+    if len(chat_messages) - start > CONTEXT_MAX:
+        start = len(chat_messages) - CONTEXT_RESET
+        if chat_messages[start]["role"] != "user":  # never open on an assistant turn
+            start += 1
+        starts[chat_id] = start
+    sizes = [message_chars(m) for m in chat_messages[start:]]
+    total = sum(sizes)
+    if total > budget:
+        last = len(chat_messages) - 1
+        for size in sizes:  # drop oldest messages until the rest fits
+            if total <= budget or start == last:
+                break
+            total -= size
+            start += 1
+        while start < last and chat_messages[start]["role"] != "user":
+            start += 1
+        starts[chat_id] = start
+    if first_turn and start <= len(first_turn):  # window already starts at the top
+        return [], chat_messages
+    return (first_turn if start else []), chat_messages[start:]
+IMAGE_OMITTED = {"type": "text", "text": "[image omitted]"}
+# Marks the gap between the kept first turn (or the system prompt) and a window that
+# skips older turns; constant, so the cacheable prefix stays identical between resets.
+HISTORY_OMITTED = {"role": "system", "content": "Earlier messages in this conversation were omitted."}
+def build_api_messages(chat_messages, first_turn=(), omitted: bool = False) -> list[dict]:
+    """
+    Build the request payload: system prompt + history, in one list.
+    `omitted` marks a window that skips older turns: `first_turn` is sent, then
+    HISTORY_OMITTED, then the window.
+    Text-only messages are passed through by reference (no copies); only messages
+    with images get a new dict, with refs expanded into image_url items. Only the
+    most recent message with images keeps them; older ones get a short text stub
+    so earlier pictures aren't re-uploaded on every turn.
+    """
+    if omitted:
+        chat_messages = [*first_turn, HISTORY_OMITTED, *chat_messages]
+    api_messages = []
+    keep_images = True  # walking newest -> oldest
+    for m in reversed(chat_messages):
+        if m is HISTORY_OMITTED:
+            api_messages.append(m)
+        elif any(item["type"] == "image_ref" for item in m["content"]):
+            content = [
+                (
+                    {"type": "image_url", "image_url": {"url": image_data_url(item["id"])}}
+                    if keep_images else IMAGE_OMITTED
+                )
+                if item["type"] == "image_ref" else item
+                for item in m["content"]
+            ]
+            api_messages.append({"role": m["role"], "content": content})
+            keep_images = False
+        elif "compare" in m:  # the side-by-side reply stays local
+            api_messages.append({"role": m["role"], "content": m["content"]})
+        else:
+            api_messages.append(m)
+    api_messages.append(SYSTEM_MESSAGE)
+    api_messages.reverse()
+    return api_messages
+def prune_images() -> None:
+    """Drop stored images that no remaining message references."""
+    live = {
+        item["id"]
+        for chat_messages in st.session_state.conversations.values()
+        for m in chat_messages
+        for item in m["content"]
+        if item["type"] == "image_ref"
+    }
+    for img_id in st.session_state.images.keys() - live:
+        del st.session_state.images[img_id]
+def evict_old_chats() -> None:
+    """Drop the least recently used chats beyond MAX_CHATS (dict order = recency)."""
+    conversations = st.session_state.conversations
+    if len(conversations) <= MAX_CHATS:
+        return
+    while len(conversations) > MAX_CHATS:
+        chat_id = next(iter(conversations))
+        del conversations[chat_id]
+        st.session_state.chat_previews.pop(chat_id, None)
+        st.session_state.context_starts.pop(chat_id, None)
+    prune_images()
+def trim_chat(chat_id: str) -> None:
+    """
+    Keep at most MAX_CHAT_MESSAGES per chat, dropping whole turns from the front.
+    The opening pair stays: context_window sends it ahead of every window, so it
+    must not turn into a different mid-chat turn as the chat grows.
+    """
+    chat_messages = st.session_state.conversations[chat_id]
+    excess = len(chat_messages) - MAX_CHAT_MESSAGES
+    if excess <= 0:
+        return
+    excess += excess % 2  # user/assistant pairs
+    keep = first_turn_len(chat_messages)
+    del chat_messages[keep:keep + excess]
+    starts = st.session_state.context_starts
+    if starts.get(chat_id, 0) > keep:
+        starts[chat_id] = max(keep, starts[chat_id] - excess)
+    prune_images()
+def uploader_key() -> str:
+    return f"uploader_{st.session_state.uploader_counter}"
+def reset_uploader() -> None:
+    """
+    Clear the attachment. File uploaders can't be reset through session state, so
+    re-key the widget, but only when it actually holds a file: an empty uploader
+    keeps its key and isn't rebuilt.
+    """
+    if st.session_state.get(uploader_key()) is not None:
+        st.session_state.uploader_counter += 1
+# Sidebar buttons use on_click callbacks: they run before the rerun the click
+# triggers, so that rerun already renders the right chat (no extra st.rerun()).
+def next_chat_id() -> str:
+    """Sequential per-session ids: unlike timestamps, two chats can't collide."""
+    st.session_state.chat_seq += 1
+    return str(st.session_state.chat_seq)
 def new_chat():
-    chat_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    chat_id = next_chat_id()
     st.session_state.current_chat_id = chat_id
     st.session_state.conversations[chat_id] = []
-    st.session_state.uploader_counter += 1
-    st.rerun()
-def get_preview(chat_messages, max_len: int = 34) -> str:
-    """Return a short label preview based on the last user message."""
-    last_user_text = ""
-    for m in reversed(chat_messages):
-        if m.get("role") == "user":
-            for item in m.get("content", []):
-                if item.get("type") == "text":
-                    last_user_text = item.get("text", "")
-                    break
-        if last_user_text:
-            break
-    if not last_user_text:
-        return "New chat"
-    last_user_text = " ".join(last_user_text.split())
-    return (last_user_text[:max_len] + "…") if len(last_user_text) > max_len else last_user_text
+    evict_old_chats()
+    st.session_state.history_limit = HISTORY_PAGE
+    reset_uploader()
+def select_chat(chat_id: str) -> None:
+    conversations = st.session_state.conversations
+    conversations[chat_id] = conversations.pop(chat_id)  # mark most recently used
+    st.session_state.current_chat_id = chat_id
+    st.session_state.history_limit = HISTORY_PAGE
+    reset_uploader()
+def show_earlier_messages() -> None:
+    st.session_state.history_limit += HISTORY_PAGE
+# Content item type -> renderer. Images pass raw bytes, which go through Streamlit's
+# media store and are served by URL (browser-cacheable); a data URL would be re-sent
+# inline every rerun.
+_ITEM_RENDERERS = {
+    "text": lambda item: st.markdown(item["text"]),
+    "image_ref": lambda item: st.image(st.session_state.images[item["id"]][1]),
+}
+def render_message(msg) -> None:
+    with st.chat_message(msg["role"]):
+        if "compare" in msg:
+            left, right = st.columns(2)
+            left.caption(model_label(MODEL))
+            left.markdown(msg["content"][0]["text"])
+            right.caption(model_label(msg["compare"]["model"]))
+            right.markdown(msg["compare"]["text"])
+            return
+        for item in msg["content"]:
+            _ITEM_RENDERERS[item["type"]](item)
+@st.fragment
+def chat_history(chat_messages: list[dict], end: int) -> None:
+    """
+    Newest HISTORY_PAGE messages before `end`; "Load earlier" reruns only this
+    fragment, not the app. A fragment rerun reuses the same list, which by then may
+    hold a turn the send logic drew outside the fragment, so `end` snapshots its
+    length from the full run.
+    """
+    hidden = end - st.session_state.history_limit
+    if hidden > 0:
+        st.button(f"⬆️ Load earlier messages ({hidden} hidden)", on_click=show_earlier_messages)
+    for msg in itertools.islice(chat_messages, max(hidden, 0), end):
+        render_message(msg)
+_STREAM_END = object()
+def _pump_stream(completion, out: queue.SimpleQueue, tag: int) -> None:
+    """
+    Read the HTTP stream on a worker thread so redraws never stall network reads.
+    Items are queued as (tag, delta) so several streams can share one queue.
+    """
+    put = out.put
+    try:
+        for chunk in completion:
+            choices = chunk.choices
+            if not choices:  # usage-only / keep-alive chunks
+                continue
+            delta = choices[0].delta.content
+            if not delta:  # role / finish_reason chunks carry no text
+                continue
+            put((tag, delta))
+    except Exception as exc:  # handed to the script thread and re-raised there
+        put((tag, exc))
+    finally:
+        put((tag, _STREAM_END))
+def _start_pumps(completions) -> queue.SimpleQueue:
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    for tag, completion in enumerate(completions):
+        threading.Thread(target=_pump_stream, args=(completion, q, tag), daemon=True).start()
+    return q
+def create_completion(model: str, api_messages: list[dict], max_tokens: int):
+    # max_tokens is passed in: stream_compare calls this from worker threads, which
+    # can't read st.session_state.
+    return client.chat.completions.create(
+        model=model,
+        messages=api_messages,
+        temperature=0.9,
+        max_completion_tokens=max_tokens,
+        stream=True
+    )
+def stream_text(completion):
+    """
+    Yield the streamed reply in batches, one per redraw: at most one every
+    STREAM_FLUSH_INTERVAL, preferably ending on a word or sentence break
+    (see STREAM_FLUSH_MAX_WAIT).
+    Tokens keep arriving on a reader thread while the UI is being redrawn, and a
+    pending batch is flushed on time even if the model pauses.
+    """
+    get = _start_pumps([completion]).get
+    monotonic = time.monotonic  # locals: this loop runs once per token
+    interval = STREAM_FLUSH_INTERVAL
+    max_wait = STREAM_FLUSH_MAX_WAIT
+    min_chars = STREAM_FLUSH_CHARS
+    boundary = STREAM_FLUSH_BOUNDARY
+    batch: list[str] = []
+    append = batch.append
+    pending = 0  # chars in batch
+    last_flush = 0.0  # first token renders immediately
+    try:
+        while True:
+            timeout = None
+            if batch:
+                elapsed = monotonic() - last_flush
+                timeout = max(0.0, (interval if elapsed < interval else max_wait) - elapsed)
+            try:
+                _, item = get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item is not None:
+                append(item)
+                pending += len(item)
+            if batch:
+                now = monotonic()
+                elapsed = now - last_flush
+                if elapsed >= max_wait or (
+                    elapsed >= interval and (pending >= min_chars or batch[-1][-1] in boundary)
+                ):
+                    yield "".join(batch)
+                    batch.clear()
+                    pending = 0
+                    last_flush = now
+        if batch:
+            yield "".join(batch)
+    finally:
+        # Interrupted (e.g. a rerun mid-stream): stop the reader and free the connection.
+        completion.close()
+def _safe_split(text: str) -> int:
+    """Index just past the last blank line outside a code fence (0 if there is none)."""
+    cut = text.rfind("\n\n")
+    while cut > 0:
+        if text.count("```", 0, cut) % 2 == 0:
+            return cut + 2
+        cut = text.rfind("\n\n", 0, cut)
+    return 0
+def render_stream(completion, parts: list[str] | None = None) -> str:
+    """
+    Render a streamed reply and return its full text.
+    Completed paragraphs are written once into a frozen container; only the
+    short tail after them is re-rendered per flush, so redraw cost stays bounded
+    instead of re-parsing the whole reply every time.
+    Batches are collected in `parts`, so a caller can keep a partial reply when
+    the run is interrupted.
+    """
+    frozen = st.container()
+    tail_placeholder = st.empty()
+    if parts is None:
+        parts = []
+    tail = ""
+    for batch in stream_text(completion):
+        parts.append(batch)
+        tail += batch
+        if len(tail) > STREAM_TAIL_CHARS:
+            cut = _safe_split(tail)
+            if cut:
+                frozen.markdown(tail[:cut])
+                tail = tail[cut:]
+        tail_placeholder.markdown(tail + "▌")
+    tail_placeholder.markdown(tail)
+    return "".join(parts)
+def stream_compare(
+    api_messages: list[dict], max_tokens: int, parts: list[list[str]] | None = None
+) -> tuple[str, str]:
+    """
+    Stream MODEL and COMPARE_MODEL side by side. Both requests are opened
+    concurrently (the pooled client reuses warm connections), so the wait is the
+    slower model's, not the sum of both. Returns (main reply, compare reply).
+    `parts` collects each model's batches, as in render_stream.
+    """
+    models = (MODEL, COMPARE_MODEL)
+    with ThreadPoolExecutor(max_workers=len(models)) as pool:
+        futures = [pool.submit(create_completion, m, api_messages, max_tokens) for m in models]
+    completions = []
+    error = None
+    for future in futures:
+        try:
+            completions.append(future.result())
+        except Exception as exc:
+            error = error or exc
+    if parts is None:
+        parts = [[] for _ in models]
+    try:
+        if error is not None:  # one request failed: the finally closes the other
+            raise error
+        placeholders = []
+        for col, model in zip(st.columns(len(models)), models):
+            col.caption(model_label(model))
+            placeholders.append(col.empty())
+        q = _start_pumps(completions)
+        open_streams = len(models)
+        dirty: set[int] = set()  # only columns with new text are joined + redrawn
+        last_flush = 0.0
+        while open_streams:
+            timeout = None
+            if dirty:
+                timeout = max(0.0, STREAM_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+            try:
+                tag, item = q.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STREAM_END:
+                open_streams -= 1
+                dirty.discard(tag)
+                placeholders[tag].markdown("".join(parts[tag]))  # final, no cursor
+            elif isinstance(item, Exception):
+                raise item
+            elif item is not None:
+                parts[tag].append(item)
+                dirty.add(tag)
+            now = time.monotonic()
+            if dirty and now - last_flush >= STREAM_FLUSH_INTERVAL:
+                for i in dirty:
+                    placeholders[i].markdown("".join(parts[i]) + "▌")
+                dirty.clear()
+                last_flush = now
+    finally:
+        for completion in completions:
+            completion.close()
+    return "".join(parts[0]), "".join(parts[1])
+def model_label(model: str) -> str:
+    return model.rsplit("/", 1)[-1]
+@st.fragment
+def attachment_picker(key: str) -> None:
+    """Uploader in its own fragment: picking a file reruns only this widget, not the app."""
+    uploaded = st.file_uploader(
+        "📎 Attach an image (optional)",
+        type=["png", "jpg", "jpeg"],
+        key=key,
+        label_visibility="visible"
+    )
+    # Encode as soon as a file is picked, while the user is still typing, so sending
+    # hits the cache instead of adding the resize/encode time to the reply latency.
+    if uploaded is not None and st.session_state.get("encoded_upload_id") != uploaded.file_id:
+        encode_upload(uploaded)
+        st.session_state.encoded_upload_id = uploaded.file_id
+def get_preview(text: str, max_len: int = 34) -> str:
+    """Short sidebar label from a user message; only the head is normalized."""
+    preview = " ".join(text[:max_len].split())
+    return (preview + "…") if len(text) > max_len else preview
 # Apply UI theme first (so it affects everything below)
 apply_ui(st.session_state.theme_mode, st.session_state.starry_bg, st.session_state.wrap_code)
 # ==========================================================
@@ -363,29 +810,24 @@ apply_ui(st.session_state.theme_mode, st.session_state.starry_bg, st.session_sta
 # ==========================================================
 if "conversations" not in st.session_state:
     st.session_state.conversations = {}
+if "chat_seq" not in st.session_state:
+    st.session_state.chat_seq = 0  # last chat id handed out
 if "current_chat_id" not in st.session_state:
-    chat_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    chat_id = next_chat_id()
     st.session_state.current_chat_id = chat_id
     st.session_state.conversations[chat_id] = []
 if "uploader_counter" not in st.session_state:
     st.session_state.uploader_counter = 0
-# ==========================================================
-# SIDEBAR
-# ==========================================================
-with st.sidebar:
-    st.markdown("### 💬 Chats")
-    if st.button("➕ New Chat", use_container_width=True):
-        new_chat()
-    st.divider()
-    for chat_id in reversed(list(st.session_state.conversations.keys())):
-        preview = get_preview(st.session_state.conversations[chat_id]) if st.session_state.show_previews else f"Chat {chat_id[-6:]}"
-        label = f"🗨️ {preview}"
-        if st.button(label, key=f"chat_{chat_id}", use_container_width=True):
-            st.session_state.current_chat_id = chat_id
-            st.session_state.uploader_counter += 1
-            st.rerun()
-    st.divider()
-    st.caption("Tip: Add your Groq key in **Secrets** (cloud) or a local **.env** file.")
+if "chat_previews" not in st.session_state:
+    st.session_state.chat_previews = {}  # chat id -> sidebar label, refreshed on each user message
+if "context_starts" not in st.session_state:
+    st.session_state.context_starts = {}  # chat id -> index of first message sent as context
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE  # messages rendered for the open chat
+if "images" not in st.session_state:
+    st.session_state.images = {}  # image id -> (mime, bytes), shared by all chats
+if "image_url" not in st.session_state:
+    st.session_state.image_url = (None, None)  # (image id, data URL) last sent to the API
 # ==========================================================
 # TOP BAR + SETTINGS (popover)
 # ==========================================================
@@ -407,87 +849,110 @@ with col_a:
 with col_b:
     with st.popover("⚙️", use_container_width=True):
         st.markdown("#### Settings")
-        theme = st.radio(
-            "Appearance",
-            ["Light", "Dark", "System"],
-            index=["Light", "Dark", "System"].index(st.session_state.theme_mode),
-            horizontal=True
+        # Widgets are keyed on the settings themselves: a change is written to
+        # session_state before the rerun it triggers, so apply_ui above already
+        # sees the new value and no second rerun is needed.
+        theme = st.radio("Appearance", ["Light", "Dark", "System"], key="theme_mode", horizontal=True)
+        st.toggle("Wrap long lines for code blocks", key="wrap_code")
+        st.toggle("Show conversation previews in history", key="show_previews")
+        st.select_slider(
+            "Max reply length (tokens)",
+            MAX_TOKENS_OPTIONS,
+            key="max_tokens",
+            help="Shorter limits finish sooner; long answers may be cut off."
         )
-        wrap_code = st.toggle("Wrap long lines for code blocks", value=st.session_state.wrap_code)
-        show_previews = st.toggle("Show conversation previews in history", value=st.session_state.show_previews)
-        starry_bg = st.session_state.starry_bg
-        if theme == "Dark":
-            starry_bg = st.toggle("Enable starry background", value=st.session_state.starry_bg)
-        else:
-            st.caption("Starry background is available in Dark mode.")
-        # Apply changes
-        changed = (
-            theme != st.session_state.theme_mode
-            or wrap_code != st.session_state.wrap_code
-            or show_previews != st.session_state.show_previews
-            or starry_bg != st.session_state.starry_bg
+        st.toggle(
+            f"Compare with {model_label(COMPARE_MODEL)}",
+            key="compare_mode",
+            help="Stream a second model's answer side by side. Only the main model's reply is kept as context."
         )
-        if changed:
-            st.session_state.theme_mode = theme
-            st.session_state.wrap_code = wrap_code
-            st.session_state.show_previews = show_previews
-            st.session_state.starry_bg = starry_bg
-            st.rerun()
+        # Always rendered (disabled outside Dark) so Streamlit keeps its state.
+        st.toggle("Enable starry background", key="starry_bg", disabled=theme != "Dark")
+        if theme != "Dark":
+            st.caption("Starry background is available in Dark mode.")
 # ==========================================================
 # MAIN CHAT "CARD"
 # ==========================================================
 st.markdown('<div class="ms-card">', unsafe_allow_html=True)
-messages = st.session_state.conversations[st.session_state.current_chat_id]
-# Display chat history
-for msg in messages:
-    with st.chat_message(msg["role"]):
-        for item in msg["content"]:
-            if item["type"] == "text":
-                st.markdown(item["text"])
-            elif item["type"] == "image_url":
-                st.image(item["image_url"]["url"])
-# Input area (uploader + chat input)
-with st.container():
-    st.markdown('<div class="ms-uploader">', unsafe_allow_html=True)
-    uploaded_image = st.file_uploader(
-        "📎 Attach an image (optional)",
-        type=["png", "jpg", "jpeg"],
-        key=f"uploader_{st.session_state.uploader_counter}",
-        label_visibility="visible"
-    )
-    st.markdown("</div>", unsafe_allow_html=True)
+current_id = st.session_state.current_chat_id
+messages = st.session_state.conversations[current_id]
+chat_history(messages, len(messages))
+# Chat input is pinned to the bottom wherever it's declared; the uploader is drawn
+# after the send logic so a finished turn can hand it a fresh key in the same run.
 user_prompt = st.chat_input("Type a message and press Enter…")
+uploaded_image = st.session_state.get(uploader_key())
 # Send logic
 if user_prompt and user_prompt.strip():
-    user_content = [{"type": "text", "text": user_prompt.strip()}]
+    prompt = user_prompt.strip()
+    user_content = [{"type": "text", "text": prompt}]
     if uploaded_image:
-        image_b64 = image_to_base64(uploaded_image)
-        user_content.append({
-            "type": "image_url",
-            "image_url": {"url": f"data:image/png;base64,{image_b64}"}
-        })
-    # Save user message
-    messages.append({"role": "user", "content": user_content})
+        user_content.append({"type": "image_ref", "id": store_image(uploaded_image)})
+    # Save + show the user message right away, then stream the reply in the same run
+    user_msg = {"role": "user", "content": user_content}
+    messages.append(user_msg)
+    st.session_state.chat_previews[current_id] = get_preview(prompt)
+    render_message(user_msg)
     # Assistant response (streaming)
-    with st.chat_message("assistant"):
-        placeholder = st.empty()
-        full_response = ""
-        completion = client.chat.completions.create(
-            model="meta-llama/llama-4-maverick-17b-128e-instruct",
-            messages=[
-                {"role": "system", "content": "You are a professional, helpful AI assistant."},
-                *messages
-            ],
-            temperature=0.9,
-            max_completion_tokens=1024,
-            stream=True
+    first_turn, window = context_window(current_id, messages)
+    api_messages = build_api_messages(
+        window, first_turn, omitted=len(first_turn) + len(window) < len(messages)
+    )
+    # Any click (Stop, another chat, a setting) reruns the app, which interrupts this
+    # run mid-stream and closes the HTTP stream; whatever arrived so far is kept.
+    # API errors (rate limit, bad key, dropped stream) are reported inline so the rest
+    # of the page (uploader, sidebar) is still drawn below. Streamlit's rerun/stop
+    # signals derive from BaseException since 1.38 (hence the floor in
+    # requirements.txt), so `except Exception` lets them pass straight through.
+    compare = st.session_state.compare_mode
+    reply_parts: list[list[str]] = [[], []]
+    failed = False
+    try:
+        with st.chat_message("assistant"):
+            stop_slot = st.empty()
+            stop_slot.button("⏹ Stop", key="stop_stream", help="Stop generating and keep the reply so far")
+            max_tokens = st.session_state.max_tokens
+            try:
+                if compare:
+                    stream_compare(api_messages, max_tokens, reply_parts)
+                else:
+                    render_stream(create_completion(MODEL, api_messages, max_tokens), reply_parts[0])
+            except Exception as exc:
+                failed = True
+                st.error(f"The model request failed: {exc}")
+            finally:
+                stop_slot.empty()
+    finally:
+        # A Stop keeps the text as-is; text from a stream that failed is flagged.
+        full_response, compare_response = (
+            text + REPLY_CUT_OFF if failed and text else text
+            for text in map("".join, reply_parts)
         )
-        for chunk in completion:
-            delta = chunk.choices[0].delta.content
-            if delta:
-                full_response += delta
-                placeholder.markdown(full_response)
-    messages.append({"role": "assistant", "content": [{"type": "text", "text": full_response}]})
-    st.session_state.uploader_counter += 1
-    st.rerun()
+        if full_response or compare_response:  # nothing to keep if no model sent any text
+            # The main reply is what goes back to the model as context, so it must not
+            # be empty even when only the compare model answered.
+            full_response = full_response or NO_REPLY
+            assistant_msg = {"role": "assistant", "content": [{"type": "text", "text": full_response}]}
+            if compare:
+                assistant_msg["compare"] = {"model": COMPARE_MODEL, "text": compare_response}
+            messages.append(assistant_msg)
+            trim_chat(current_id)
+        reset_uploader()
+# Input area (uploader)
+with st.container():
+    st.markdown('<div class="ms-uploader">', unsafe_allow_html=True)
+    attachment_picker(uploader_key())
+    st.markdown("</div>", unsafe_allow_html=True)
 st.markdown("</div>", unsafe_allow_html=True)
+# ==========================================================
+# SIDEBAR (rendered last so previews include this run's turn)
+# ==========================================================
+with st.sidebar:
+    st.markdown("### 💬 Chats")
+    st.button("➕ New Chat", use_container_width=True, on_click=new_chat)
+    st.divider()
+    for chat_id in reversed(st.session_state.conversations):  # most recently used first
+        preview = st.session_state.chat_previews.get(chat_id, "New chat") if st.session_state.show_previews else f"Chat {chat_id}"
+        label = f"🗨️ {preview}"
+        st.button(label, key=f"chat_{chat_id}", use_container_width=True, on_click=select_chat, args=(chat_id,))
+    st.divider()
+    st.caption("Tip: Add your Groq key in **Secrets** (cloud) or a local **.env** file.")